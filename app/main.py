@@ -1,14 +1,19 @@
-import csv
 import datetime
+import functools
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import io
+from types import SimpleNamespace
 
 from dateutil import parser
 import boto3
 from boto3.dynamodb.conditions import Key
 import requests
+from requests.adapters import HTTPAdapter
 from decimal import *
 import logging
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import sys
 
@@ -20,16 +25,58 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 log_handler.setFormatter(formatter)
 LOGGER.addHandler(log_handler)
 
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table("river_levels")
+# Keep the DynamoDB sockets alive and pooled so warm invocations reuse the TLS connection rather than
+# re-handshaking on every call (the boto3 equivalent of AWS_NODEJS_CONNECTION_REUSE_ENABLED in the js sdk).
+DYNAMODB_CONFIG = Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+)
+
+TABLE_NAME = "river_levels"
+
+_table = None
+
+
+def get_table():
+    # built on first use rather than at import, so cold starts of paths that never touch dynamo don't pay for it,
+    # then cached so warm invocations keep reusing its connection pool
+    global _table
+    if _table is None:
+        _table = boto3.resource("dynamodb", config=DYNAMODB_CONFIG).Table(TABLE_NAME)
+    return _table
+
+
+# one session for all the epa requests so warm invocations reuse the open connection and skip the TLS handshake
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+EPA_GAUGES_URL = "https://epawebapp.epa.ie/Hydronet/output/internet/layers/10/index.json"
+# how long the latest readings of every gauge are reused for, well under the 5 minutes between current level updates
+GAUGES_CACHE_SECONDS = 60
 
 FLESK_GAUGE_NUMBER = 22039
 FLESK_PAST_DATA = "https://epawebapp.epa.ie/Hydronet/output/internet/stations/LIM/22039/S/complete_15min.zip"
+# rows may or may not carry seconds, only the date, hour and minute are read, as they always were
+EPA_CSV_TIME_FORMAT = "%Y-%m-%d %H:%M"
+# rows are ~30 bytes, this is an upper bound used to size the window we read from the end of the csv
+EPA_CSV_MAX_ROW_BYTES = 64
 
 LAST_N_READINGS = 100
 
+# gauge readings only ever have a few digits, so convert them through one small fixed context rather than the global one
+LEVEL_CONTEXT = Context(prec=6)
+
+# BatchWriteItem accepts at most 25 puts per request
+DYNAMO_BATCH_SIZE = 25
+DYNAMO_BATCH_WORKERS = 8
+DYNAMO_BATCH_MAX_RETRIES = 5
+
 
 class Level:
+    # thousands of these get built per run, slots drop the per instance __dict__
+    __slots__ = ("time", "level")
+
     def __init__(self, time: datetime.datetime = 0, level: Decimal = 1):
         self.time = time
         self.level = level
@@ -37,7 +84,7 @@ class Level:
 
 def update_level_db(level: Level) -> bool:
     try:
-        table.put_item(
+        get_table().put_item(
             Item={
                 'river_name': "Flesk",
                 'timestamp': int(level.time.timestamp()),
@@ -54,103 +101,222 @@ def update_level_db(level: Level) -> bool:
     return True
 
 
+def write_batch_dynamo(client, put_requests: [dict]):
+    request_items = {TABLE_NAME: put_requests}
+    for attempt in range(DYNAMO_BATCH_MAX_RETRIES + 1):
+        response = client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+        if attempt < DYNAMO_BATCH_MAX_RETRIES:
+            # writes can come back unprocessed when we're throttled, so back off before resending them
+            time.sleep(0.05 * 2 ** attempt)
+    raise RuntimeError(f"Could not write {len(request_items[TABLE_NAME])} levels to {TABLE_NAME}")
+
+
 def batch_update_level_db(river_name: str, levels: [Level]):
-    with table.batch_writer(overwrite_by_pkeys=['river_name', 'timestamp']) as batch:
-        for i, level in enumerate(levels):
-            print(i)
-            batch.put_item(
-                Item={
+    # keyed on timestamp so a repeated reading overwrites the earlier one, dynamo rejects a batch with duplicate keys
+    put_requests = {}
+    for i, level in enumerate(levels):
+        if i % 500 == 0:
+            LOGGER.debug("Prepared %d levels for writing", i)
+        timestamp = int(level.time.timestamp())
+        put_requests[timestamp] = {
+            'PutRequest': {
+                'Item': {
                     'river_name': river_name,
-                    'timestamp': int(level.time.timestamp()),
+                    'timestamp': timestamp,
                     'level': level.level,
                 }
+            }
+        }
+
+    put_requests = list(put_requests.values())
+    batches = [put_requests[i:i + DYNAMO_BATCH_SIZE] for i in range(0, len(put_requests), DYNAMO_BATCH_SIZE)]
 
-            )
+    # the resource's client is thread safe, unlike the table resource itself, and still converts plain python values
+    # to and from dynamo's types, including any UnprocessedItems handed back for retrying
+    client = get_table().meta.client
+    with ThreadPoolExecutor(max_workers=DYNAMO_BATCH_WORKERS) as executor:
+        # consume the results so any failed batch raises here
+        list(executor.map(lambda batch: write_batch_dynamo(client, batch), batches))
+
+
+def parse_epa_timestamp(timestamp: str) -> datetime.datetime:
+    # fromisoformat is much cheaper than dateutil, but before python 3.11 it can't handle a trailing Z so fall back
+    # to dateutil for anything it rejects
+    try:
+        return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return parser.parse(timestamp)
+
+
+@functools.lru_cache(maxsize=1)
+def get_gauges_by_station_no(ttl_hash: int) -> {str: dict}:
+    # ttl_hash only exists to expire the cache, callers pass a value that changes every GAUGES_CACHE_SECONDS
+    response = SESSION.get(EPA_GAUGES_URL)
+    return {gauge['metadata_station_no']: gauge for gauge in response.json()}
 
 
 def get_latest_level(gauge_number: int) -> Level:
-    response = requests.get("https://epawebapp.epa.ie/Hydronet/output/internet/layers/10/index.json")
-    gauges = response.json()
-    for gauge in gauges:
-        if gauge['metadata_station_no'] == str(gauge_number):
-            parsed_time = parser.parse(gauge['L1_timestamp'])
-            return Level(
-                level=Decimal(gauge['L1_ts_value']) - Decimal(gauge['L1_station_gauge_datum']),
-                time=parsed_time
-            )
-    print("could not find gauge...")
+    gauges = get_gauges_by_station_no(int(time.time() // GAUGES_CACHE_SECONDS))
+    gauge = gauges.get(str(gauge_number))
+    if gauge is None:
+        print("could not find gauge...")
+        return None
+
+    parsed_time = parse_epa_timestamp(gauge['L1_timestamp'])
+    return Level(
+        level=LEVEL_CONTEXT.subtract(
+            LEVEL_CONTEXT.create_decimal(gauge['L1_ts_value']),
+            LEVEL_CONTEXT.create_decimal(gauge['L1_station_gauge_datum']),
+        ),
+        time=parsed_time
+    )
 
 
 def get_past_data_epa(n_last_readings: int) -> [Level]:
-    response = requests.get(FLESK_PAST_DATA, stream=True)
+    # pandas is slow to import and only the hourly past update parses the csv, so keep it off everyone else's
+    # cold start
+    import pandas as pd
+
+    # zipfile needs to seek, so the archive is buffered in memory, but the csv is read straight out of it
+    response = SESSION.get(FLESK_PAST_DATA)
     z = zipfile.ZipFile(io.BytesIO(response.content))
-    z.extract("complete_15min.csv")
 
-    with open("complete_15min.csv") as f:
-        csv_reader = csv.reader(f, delimiter=' ', )
-        rows = [row for row in csv_reader if "#" not in row[0]]
+    # the csv holds years of readings but we only want the newest few, so skip straight to a window at the end
+    # of it, generously sized so it always covers n_last_readings rows
+    csv_size = z.getinfo("complete_15min.csv").file_size
+    window_start = max(0, csv_size - n_last_readings * EPA_CSV_MAX_ROW_BYTES)
+    with z.open("complete_15min.csv") as f:
+        f.seek(window_start)
+        if window_start:
+            # we've most likely landed part way through a row, throw it away
+            f.readline()
+        window = f.read()
+
+    # rows look like "2021-12-01 00:15:00;0.654;...", levels are kept as strings so the Decimals are exact
+    df = pd.read_csv(
+        io.BytesIO(window),
+        encoding="utf-8",
+        sep=";",
+        engine="c",
+        comment="#",
+        header=None,
+        usecols=[0, 1],
+        names=["dt", "level"],
+        dtype={"dt": str, "level": str},
+    ).tail(n_last_readings)
+
+    # readings with no level recorded, or a non numeric placeholder like "---", are skipped. The mask is only used
+    # to filter, the levels themselves stay strings so the Decimals are exact
+    df = df.dropna()
+    df = df[pd.to_numeric(df["level"], errors="coerce").notna()]
+
+    # the csv timestamps have a fixed format, giving it explicitly skips pandas' per value format sniffing
+    times = pd.to_datetime(df["dt"].str[:16], format=EPA_CSV_TIME_FORMAT, cache=True)
+
+    return [Level(time=t.to_pydatetime(), level=LEVEL_CONTEXT.create_decimal(v)) for t, v in zip(times, df["level"])]
+
+
+def get_past_levels_and_timestamps_dynamo(river_name: str, since_date: datetime.datetime) -> ([Level], {int}):
+    # the int timestamps come straight off the items, so deduping against them doesn't round trip through datetimes
+    since_timestamp = int(since_date.timestamp())
+
+    query_kwargs = {
+        'KeyConditionExpression': Key('river_name').eq(river_name) & Key('timestamp').gt(since_timestamp),
+        # only fetch the attributes we use, both names are dynamo reserved words so need aliasing
+        'ProjectionExpression': '#ts, #lv',
+        'ExpressionAttributeNames': {'#ts': 'timestamp', '#lv': 'level'},
+    }
 
+    # a single query is capped at 1MB of data, so follow LastEvaluatedKey until we have every page
     levels = []
+    timestamps = set()
+    while True:
+        response = get_table().query(**query_kwargs)
+        for item in response['Items']:
+            timestamp = int(item['timestamp'])
+            timestamps.add(timestamp)
+            levels.append(Level(time=datetime.datetime.fromtimestamp(timestamp), level=item['level']))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
-    for row in rows[- n_last_readings:]:
-        date = row[0]
-        time = row[1].split(";")[0]
-        parsed_time = datetime.datetime(
-            year=int(date.split("-")[0]),
-            month=int(date.split("-")[1]),
-            day=int(date.split("-")[2]),
-            hour=int(time.split(":")[0]),
-            minute=int(time.split(":")[1])
-        )
+    return levels, timestamps
 
-        try:
-            levels.append(Level(time=parsed_time, level=Decimal(row[1].split(";")[1])))
-        except:
-            pass
 
+def get_past_data_dynamo(river_name: str, since_date: datetime.datetime) -> [Level]:
+    levels, _ = get_past_levels_and_timestamps_dynamo(river_name, since_date)
     return levels
 
 
-def get_past_data_dynamo(river_name: str, since_date: datetime.datetime) -> [Level]:
-    since_timestamp = int(since_date.timestamp())
-
-    response = table.query(
-        KeyConditionExpression=Key('river_name').eq(river_name) & Key('timestamp').gt(since_timestamp)
+def get_most_recent_data_dynamo(river_name: str) -> Level:
+    # newest first and stop after one, so this is a single item read rather than the whole partition
+    response = get_table().query(
+        KeyConditionExpression=Key('river_name').eq(river_name),
+        ScanIndexForward=False,
+        Limit=1,
     )
+    items = response['Items']
+    if not items:
+        return None
+    return Level(time=datetime.datetime.fromtimestamp(int(items[0]['timestamp'])), level=items[0]['level'])
+
+
+_bokeh = None
+
+
+def get_bokeh() -> SimpleNamespace:
+    # bokeh and numpy are only needed when drawing, so keep them off the import path of the level updates but only
+    # import them once per container
+    global _bokeh
+    if _bokeh is None:
+        import numpy as np
+        from bokeh.models.widgets import DateRangeSlider
+        from bokeh.layouts import layout
+        from bokeh.plotting import figure
+        from bokeh.embed import file_html
+        from bokeh.resources import CDN
+
+        _bokeh = SimpleNamespace(
+            DateRangeSlider=DateRangeSlider,
+            layout=layout,
+            figure=figure,
+            file_html=file_html,
+            CDN=CDN,
+            np=np,
+        )
+    return _bokeh
 
-    return [Level(time=datetime.datetime.fromtimestamp(int(item['timestamp'])), level=item['level']) for item in
-            response['Items']]
-
-
-def get_most_recent_data_dynamo(river_name: str) -> [Level]:
-    response = table.query(
-        ExpressionAttributeValues=Key('river_name').eq(river_name)
-    )
-    return [Level(time=datetime.datetime.fromtimestamp(int(item['timestamp'])), level=item['level']) for item in
-            response['Items']]
 
+def draw_graph_levels(levels: [Level], river_name: str, low_water, high_water, interactive: bool = True) -> str:
+    bokeh = get_bokeh()
 
-def draw_graph_levels(levels: [Level], river_name: str, low_water, high_water) -> str:
-    from bokeh.models.widgets import DateRangeSlider
-    from bokeh.layouts import layout
-    from bokeh.plotting import figure, output_file, save, show
-    from bokeh.embed import file_html
-    from bokeh.resources import CDN
+    # pull the columns out once
+    n = len(levels)
+    times = [l.time for l in levels]
+    heights = bokeh.np.fromiter((float(l.level) for l in levels), dtype=float, count=n)
 
     now = datetime.datetime.now()
     two_weeks_ago = now - datetime.timedelta(days=14)
 
-    p = figure(title=f"{river_name} Gauge, current level: {levels[-1].level}m at {levels[-1].time}",
-               x_axis_type="datetime", x_axis_label='Date',
-               y_axis_label='Height', x_range=(two_weeks_ago, now))
-    p.line(x=[l.time for l in levels], y=[l.level for l in levels], legend_label="Level", line_width=2)
+    p = bokeh.figure(title=f"{river_name} Gauge, current level: {levels[-1].level}m at {levels[-1].time}",
+                     x_axis_type="datetime", x_axis_label='Date',
+                     y_axis_label='Height', x_range=(two_weeks_ago, now))
+    p.line(x=times, y=heights, legend_label="Level", line_width=2)
 
-    p.line(x=[l.time for l in levels], y=[low_water for _ in levels], legend_label="Low Water", line_color="green",
-           line_width=1)
-    p.line(x=[l.time for l in levels], y=[high_water for _ in levels], legend_label="High Water", line_color="red",
-           line_width=1)
+    # the water marks are flat, so their ends are all that's needed to draw them
+    water_x = [times[0], times[-1]]
+    p.line(x=water_x, y=[low_water, low_water], legend_label="Low Water", line_color="green", line_width=1)
+    p.line(x=water_x, y=[high_water, high_water], legend_label="High Water", line_color="red", line_width=1)
 
-    date_range_slider = DateRangeSlider(
+    if not interactive:
+        # nothing will use the date slider, so skip building it and its layout and render the plot on its own
+        p.sizing_mode = 'stretch_width'
+        return bokeh.file_html(p, bokeh.CDN, river_name)
+
+    date_range_slider = bokeh.DateRangeSlider(
         title="Date Range",
         start=levels[0].time,
         end=datetime.datetime.now(),
@@ -161,7 +327,7 @@ def draw_graph_levels(levels: [Level], river_name: str, low_water, high_water) -
     date_range_slider.js_link("value", p.x_range, "start", attr_selector=0)
     date_range_slider.js_link("value", p.x_range, "end", attr_selector=1)
 
-    layout = layout(
+    layout = bokeh.layout(
         [
             [p],
             [date_range_slider]
@@ -170,7 +336,7 @@ def draw_graph_levels(levels: [Level], river_name: str, low_water, high_water) -
         sizing_mode='stretch_width'
     )
 
-    return file_html(layout, CDN, river_name)
+    return bokeh.file_html(layout, bokeh.CDN, river_name)
 
 
 def update_current_levels_table_handler(event, context) -> bool:
@@ -178,39 +344,56 @@ def update_current_levels_table_handler(event, context) -> bool:
     return update_level_db(get_latest_level(FLESK_GAUGE_NUMBER))
 
 
-def update_past_levels_table_handler(event, context) -> bool:
+def update_past_levels_table_handler(event, context) -> (bool, [Level]):
+    # as well as whether anything new was written, hand back the last 50 days of levels including the new ones, so
+    # a graph drawn straight after doesn't need to query them again
     LOGGER.info("Running update_past_levels_table_handler")
 
-    # get the newest N river levels from the epa .zip file
-    epa_levels = get_past_data_epa(3000)
+    # the epa download and the dynamo query don't depend on each other, so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # get the newest N river levels from the epa .zip file
+        epa_future = executor.submit(get_past_data_epa, 3000)
 
-    # get the most resent river levels in our table
-    dynamo_levels = get_past_data_dynamo("Flesk", datetime.datetime.now() - datetime.timedelta(days=50))
-    dynamo_times = {level.time for level in dynamo_levels}
+        # get the most resent river levels in our table
+        dynamo_future = executor.submit(
+            get_past_levels_and_timestamps_dynamo, "Flesk", datetime.datetime.now() - datetime.timedelta(days=50)
+        )
 
-    # to save doing extra work we only try to write new level readings to db
-    new_river_levels = [level for level in epa_levels if level.time not in dynamo_times]
+        epa_levels = epa_future.result()
+        dynamo_levels, dynamo_timestamps = dynamo_future.result()
+
+    # to save doing extra work we only try to write new level readings to db, compared on the int timestamps
+    # we store rather than on datetimes
+    epa_levels_by_timestamp = {int(level.time.timestamp()): level for level in epa_levels}
+    new_timestamps = sorted(epa_levels_by_timestamp.keys() - dynamo_timestamps)
+    new_river_levels = [epa_levels_by_timestamp[timestamp] for timestamp in new_timestamps]
 
     if new_river_levels:
         LOGGER.info("Updating db with new epa.zip data ")
         batch_update_level_db("Flesk", new_river_levels)
-        return True
+        levels = sorted(dynamo_levels + new_river_levels, key=lambda level: level.time)
+        return True, levels
     else:
         LOGGER.info("No new data from epa.zip")
-        return False
+        return False, dynamo_levels
 
 
-def create_graph_handler(event, context):
+def create_graph_handler(event, context, levels: [Level] = None):
     LOGGER.info("Running create_graph_handler")
-    levels = get_past_data_dynamo("Flesk", datetime.datetime.now() - datetime.timedelta(days=50))
-    draw_graph_levels(levels, "Flesk - Last two weeks", 0.7, 1.5)
+    if levels is None:
+        levels = get_past_data_dynamo("Flesk", datetime.datetime.now() - datetime.timedelta(days=50))
+    draw_graph_levels(levels, "Flesk - Last two weeks", 0.7, 1.5, interactive=False)
 
 
-def build_website():
+def build_website(known_levels: {str: [Level]} = None):
+    # known_levels lets a caller that has just fetched a river's levels hand them over instead of re-querying
+    known_levels = known_levels or {}
     rivers = ["Flesk", ]
     html = []
     for river in rivers:
-        levels = get_past_data_dynamo(river, datetime.datetime.now() - datetime.timedelta(days=50))
+        levels = known_levels.get(river)
+        if levels is None:
+            levels = get_past_data_dynamo(river, datetime.datetime.now() - datetime.timedelta(days=50))
         river_html = draw_graph_levels(levels, river, 0.7, 1.5)
         html.append(river_html)
 
@@ -224,10 +407,10 @@ def build_website():
     # SCPCLient takes a paramiko transport as an argument
     scp = SCPClient(ssh.get_transport())
 
-    with open("index.php", "w") as f:
-        f.write("\n".join(html))
-
-    scp.put('index.php', remote_path="www/")
+    # upload straight from memory rather than through a local file. scp only applies the mode when it creates the
+    # file, so the existing index.php still needs its permissions reset
+    payload = "\n".join(html).encode("utf-8")
+    scp.putfo(io.BytesIO(payload), remote_path="www/index.php", mode="0644")
     ssh.exec_command("chmod 644 www/index.php")
     scp.close()
 
@@ -243,9 +426,10 @@ def handler(event, context):
             LOGGER.info("no new value found")
     elif "past" in event:
         LOGGER.info("past event")
-        if update_past_levels_table_handler(event, context):
+        updated, levels = update_past_levels_table_handler(event, context)
+        if updated:
             LOGGER.info("updated db with new values, making new graph")
-            create_graph_handler(event, context)
+            create_graph_handler(event, context, levels)
         else:
             LOGGER.info("no new values found")
     else:
@@ -256,8 +440,8 @@ def main():
     # For running locally
     print("Starting: main")
     update_current_levels_table_handler(0, 0)
-    update_past_levels_table_handler(0, 0)
-    build_website()
+    _, levels = update_past_levels_table_handler(0, 0)
+    build_website({"Flesk": levels})
     print("done")
 
 